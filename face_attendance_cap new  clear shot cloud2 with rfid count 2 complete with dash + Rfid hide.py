@@ -1,24 +1,49 @@
 import os
 import cv2
+import glob
+import json
 import time
+import hashlib
 import requests
-import tempfile
+import dlib
 import numpy as np
 import face_recognition
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from requests.adapters import HTTPAdapter
+from numba import njit, prange
 from datetime import datetime, date
 from dotenv import load_dotenv
 from supabase import create_client
 import tkinter as tk
 from tkinter import scrolledtext
 from PIL import Image, ImageTk
+try:
+    import faiss          # optional: SIMD nearest-neighbour search for unknown-face dedupe
+except ImportError:
+    faiss = None
 
 # ===== Config =====
 SNAPSHOT_BUCKET = "snapshots"
+SNAPSHOT_JPEG_QUALITY = 85
 MATCH_THRESHOLD = 0.50          # face match threshold (lower is stricter)
 UNKNOWN_FACE_THRESHOLD = 0.50   # consider same unknown if distance < this (dedupe)
+UNKNOWN_FACE_THRESHOLD_SQ = UNKNOWN_FACE_THRESHOLD ** 2   # compared against squared L2, no sqrt
+ENCODING_QUANT_SCALE = 127.0 / 0.3   # int8 step for student encodings (components sit within about ±0.3)
+MATCH_THRESHOLD_Q_SQ = (MATCH_THRESHOLD * ENCODING_QUANT_SCALE) ** 2   # MATCH_THRESHOLD in squared int8 units
 SCAN_PHASE = 5                  # 0–5 sec: blue "SCANNING..."
 DECISION_PHASE = 10             # 6–10 sec: decide (match / not match)
 CAPTURE_DURATION = 15           # absolute max safety window
+CAMERA_WIDTH, CAMERA_HEIGHT = 640, 480  # plenty for 0.25x detection, far less to decode than 1080p
+FRAME_INTERVAL_MS = 30          # frame loop delay during a verification session
+IDLE_FRAME_INTERVAL_MS = 100    # frame loop delay while waiting for an RFID scan
+DETECT_EVERY = 5                # run face detection on every Nth session frame (~6 Hz); boxes are reused in between
+# dlib's CNN detector is only worth it with a CUDA build; HOG is much faster on CPU
+FACE_DETECTION_MODEL = "cnn" if dlib.DLIB_USE_CUDA else "hog"
+HTTP_POOL_SIZE = 16             # kept-alive connections for startup photo downloads
+ENCODING_CACHE_INDEX = "encodings_cache.json"     # {"matrix": file, "photos": {RFID: [[photo key, count], ...]}}
+ENCODING_CACHE_MATRIX = "encodings_cache_{}.npy"  # float32 (N, 128) rows of every cached photo, in index order
+LEGACY_ENCODING_CACHE = "encodings_cache.npz"     # older compressed cache format, removed once replaced
 
 # ===== Helpers =====
 def today_str():
@@ -27,67 +52,304 @@ def today_str():
 def now_time_str():
     return datetime.now().strftime("%H:%M:%S")
 
+def rfid_key(code):
+    # Numeric RFIDs are keyed as ints (cheaper to hash on the per-frame path); others stay strings.
+    # Only when the int round-trips exactly, so "0012345" and "12345" stay distinct cards.
+    code = str(code).strip()
+    if code.isdecimal() and str(int(code)) == code:
+        return int(code)
+    return code
+
+@njit(parallel=True, cache=True)
+def face_quality(face_bgr):
+    # Fused gray -> 4-neighbour Laplacian -> mean/variance over a uint8 BGR crop (at least 3x3).
+    # Integer-only until the final division: the stencil spans [-1020, 1020] and the sums fit int64.
+    h, w = face_bgr.shape[0], face_bgr.shape[1]
+    gray = np.empty((h, w), dtype=np.int16)
+    gray_sum = 0
+    for i in prange(h):
+        for j in range(w):
+            # Same Q14 fixed-point BT.601 weights and rounding as cv2.COLOR_BGR2GRAY
+            g = (1868 * face_bgr[i, j, 0] + 9617 * face_bgr[i, j, 1] + 4899 * face_bgr[i, j, 2] + 8192) >> 14
+            gray[i, j] = g
+            gray_sum += g
+    lap_sum = 0
+    lap_sq_sum = 0
+    for i in prange(1, h - 1):
+        for j in range(1, w - 1):
+            lap = gray[i - 1, j] + gray[i + 1, j] + gray[i, j - 1] + gray[i, j + 1] - 4 * gray[i, j]
+            lap_sum += lap
+            lap_sq_sum += lap * lap
+    n = (h - 2) * (w - 2)
+    lap_mean = lap_sum / n
+    return gray_sum / (h * w), lap_sq_sum / n - lap_mean * lap_mean
+
 def is_good_shot(face_bgr):
     if face_bgr.size == 0:
         return False
-    gray = cv2.cvtColor(face_bgr, cv2.COLOR_BGR2GRAY)
-    brightness = float(np.mean(gray))
-    sharpness = float(cv2.Laplacian(gray, cv2.CV_64F).var())
     h, w = face_bgr.shape[:2]
-    return (30 <= brightness <= 220) and (sharpness >= 20) and (h >= 60 and w >= 60)
+    if h < 60 or w < 60:
+        return False
+    brightness, sharpness = face_quality(face_bgr)
+    return (30 <= brightness <= 220) and (sharpness >= 20)
+
+def encode_snapshot(face_bgr):
+    # JPEG bytes for upload, or None if there is nothing usable to encode
+    if face_bgr is None or face_bgr.size == 0:
+        return None
+    ok, buf = cv2.imencode(".jpg", face_bgr, [cv2.IMWRITE_JPEG_QUALITY, SNAPSHOT_JPEG_QUALITY])
+    return buf.tobytes() if ok else None
+
+def quantize_encodings(encs):
+    return np.clip(np.rint(encs * ENCODING_QUANT_SCALE), -127, 127).astype(np.int8)
 
-def masked_face_encoding(img):
-    face_locations = face_recognition.face_locations(img)
+def masked_face_encoding(img, face_locations):
+    # Encode only the upper 60% of the first detected face, reusing the caller's detection
     if not face_locations:
         return None
     (top, right, bottom, left) = face_locations[0]
-    masked_img = img[top:int(top + 0.6 * (bottom - top)), left:right]
-    encs = face_recognition.face_encodings(masked_img)
+    masked_loc = (top, right, int(top + 0.6 * (bottom - top)), left)
+    encs = face_recognition.face_encodings(img, known_face_locations=[masked_loc])
     return encs[0] if encs else None
 
+# ===== Encoding cache =====
+def load_encoding_cache():
+    # Returns ({photo key: encodings}, photos index); empty if there is no usable cache yet.
+    # The encodings are views into the memory-mapped matrix, so only rows in use get paged in.
+    try:
+        with open(ENCODING_CACHE_INDEX, "r", encoding="utf-8") as fh:
+            index = json.load(fh)
+        total = sum(count for photos in index["photos"].values() for _, count in photos)
+        # numpy cannot memory-map a zero-row array
+        matrix = np.load(index["matrix"], mmap_mode="r") if total else np.empty((0, 128), dtype=np.float32)
+        cached = {}
+        offset = 0
+        for photos in index["photos"].values():
+            for h, count in photos:
+                cached[h] = matrix[offset:offset + count]
+                offset += count
+        remove_stale_cache_matrices(keep=index["matrix"])
+        return cached, index["photos"]
+    except FileNotFoundError:
+        return {}, {}
+    except Exception as e:
+        print(f"⚠️ Ignoring unreadable encoding cache: {e}")
+        return {}, {}
+
+def remove_stale_cache_matrices(keep):
+    for path in glob.glob(ENCODING_CACHE_MATRIX.format("*")):
+        if os.path.basename(path) != os.path.basename(keep):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+def save_encoding_cache(photos_by_rfid, previous_index):
+    index = {rfid: [[h, len(encs)] for h, encs in photos] for rfid, photos in photos_by_rfid.items()}
+    if index == previous_index:
+        return
+    rows = [e for photos in photos_by_rfid.values() for _, encs in photos for e in encs]
+    matrix = np.asarray(rows, dtype=np.float32).reshape(-1, 128)
+    # A fresh file per write: the previous matrix is still mapped, and Windows refuses to replace it
+    matrix_path = ENCODING_CACHE_MATRIX.format(int(time.time() * 1000))
+    try:
+        np.save(matrix_path, matrix)
+        tmp_path = ENCODING_CACHE_INDEX + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fh:
+            json.dump({"matrix": matrix_path, "photos": index}, fh)
+        os.replace(tmp_path, ENCODING_CACHE_INDEX)
+    except Exception as e:
+        print(f"⚠️ Failed to write encoding cache: {e}")
+        return
+    # The old cache holds face encodings too; don't leave it lying around once it is superseded
+    try:
+        os.remove(LEGACY_ENCODING_CACHE)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        print(f"⚠️ Failed to remove old encoding cache {LEGACY_ENCODING_CACHE}: {e}")
+
 # ===== Supabase =====
 load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 supabase = create_client(SUPABASE_URL, SUPABASE_KEY)
 
+# Keep-alive session for photo downloads instead of a new TCP+TLS connection per request
+http = requests.Session()
+http.mount("https://", HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
 # ===== Load students =====
+def photo_key(url, headers):
+    # Cache key for a photo: its URL plus the server's ETag/Last-Modified, because Supabase
+    # Storage keeps the same public URL when a photo is replaced with upsert
+    validator = headers.get("ETag") or headers.get("Last-Modified") or ""
+    return hashlib.sha1(f"{url}\n{validator}".encode("utf-8")).hexdigest()
+
+def head_photo_key(url):
+    resp = http.head(url, timeout=20, allow_redirects=True)
+    resp.raise_for_status()
+    return photo_key(url, resp.headers)
+
+def fetch_photo(url):
+    # Returns (photo key, image bytes); the key comes from the GET headers, so this also
+    # works for photos whose HEAD request failed
+    resp = http.get(url, timeout=20)
+    resp.raise_for_status()
+    return photo_key(url, resp.headers), resp.content
+
+def encode_photo(content):
+    img = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_COLOR)
+    if img is None:
+        raise ValueError("not a decodable image")
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    # HOG, not FACE_DETECTION_MODEL: CNN with the default upsample on full-size photos can exhaust GPU memory
+    face_locations = face_recognition.face_locations(img, model="hog")
+    encs = face_recognition.face_encodings(img, face_locations)
+    if not encs:
+        enc = masked_face_encoding(img, face_locations)
+        if enc is not None:
+            encs = [enc]
+    return encs
+
 print("⬇️ Loading students from Supabase...")
-student_by_rfid = {}
-encodings_by_rfid = {}
+loaded_by_rfid = {}   # RFID -> (student row, encodings); a later duplicate RFID wins
+cached_encs, cached_index = load_encoding_cache()
+photos_by_rfid = {}   # what gets written back to the cache
+reused_photos = 0
 
 students = supabase.table("students").select("id,name,photo_url,RFID_code").execute().data or []
+valid_students = []
+photo_owner = {}      # photo URL -> student name, for error messages
 for s in students:
     name, sid, rfid, url_field = s.get("name"), s.get("id"), s.get("RFID_code"), s.get("photo_url")
     if not name or not sid or not url_field or not rfid:
         continue
     urls = url_field if isinstance(url_field, list) else [url_field]
-    all_encs = []
+    valid_students.append((s, name, rfid, urls))
     for url in urls:
+        photo_owner.setdefault(url, name)
+
+# Downloads run 8-wide; encodes run on a single worker because face_recognition shares one
+# dlib detector whose scanner state is not thread-safe (dlib drops the GIL around it)
+key_by_url = {}       # photo URL -> photo key
+to_fetch = []         # URLs that need a GET: not in the cache, or HEAD failed
+fresh_encs = {}
+with ThreadPoolExecutor(max_workers=8) as dl_pool, ThreadPoolExecutor(max_workers=1) as cpu_pool:
+    # HEAD requests only: a changed ETag means the photo behind the URL was replaced
+    heads = {dl_pool.submit(head_photo_key, url): url for url in photo_owner}
+    for fut in as_completed(heads):
+        url = heads[fut]
+        try:
+            key_by_url[url] = h = fut.result()
+        except Exception:
+            # Some hosts refuse HEAD, or it hit a transient error; the GET below keys the photo instead
+            to_fetch.append(url)
+            continue
+        if h not in cached_encs:
+            to_fetch.append(url)
+
+    downloads = {dl_pool.submit(fetch_photo, url): url for url in to_fetch}
+    encodes = {}
+    queued = set()        # photo keys already handed to the encode pool
+    for fut in as_completed(downloads):
+        url = downloads[fut]
         try:
-            resp = requests.get(url, timeout=20)
-            resp.raise_for_status()
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-                tmp.write(resp.content)
-                tmp.flush()
-                img = face_recognition.load_image_file(tmp.name)
-            encs = face_recognition.face_encodings(img)
-            if not encs:
-                enc = masked_face_encoding(img)
-                if enc is not None:
-                    encs = [enc]
-            if encs:
-                all_encs.extend(encs)
+            h, content = fut.result()
         except Exception as e:
-            print(f"❌ Failed to load photo for {name}: {e}")
+            print(f"❌ Failed to load photo for {photo_owner[url]}: {e}")
+            continue
+        key_by_url[url] = h
+        if h in cached_encs or h in queued:
+            continue
+        queued.add(h)
+        encodes[cpu_pool.submit(encode_photo, content)] = h
+    owner_by_key = {h: photo_owner[url] for url, h in key_by_url.items()}
+    for fut in as_completed(encodes):
+        h = encodes[fut]
+        try:
+            fresh_encs[h] = fut.result()
+        except Exception as e:
+            print(f"❌ Failed to load photo for {owner_by_key[h]}: {e}")
+
+for s, name, rfid, urls in valid_students:
+    all_encs = []
+    photos = []
+    for url in urls:
+        h = key_by_url.get(url)
+        if h is None:
+            continue
+        if h in cached_encs:
+            encs = list(cached_encs[h])
+            reused_photos += 1
+        elif h in fresh_encs:
+            encs = fresh_encs[h]
+        else:
+            continue
+        # Photos without a usable face are cached too, so they are not re-downloaded every launch
+        photos.append((h, encs))
+        all_encs.extend(encs)
+    photos_by_rfid[str(rfid)] = photos
 
     if all_encs:
-        student_by_rfid[str(rfid)] = s
-        encodings_by_rfid[str(rfid)] = all_encs
+        loaded_by_rfid[rfid_key(rfid)] = (s, all_encs)
         print(f"✅ Loaded {name} with {len(all_encs)} encodings (RFID: {rfid})")
     else:
         print(f"⚠️ No usable faces for {name} (RFID: {rfid})")
 
+save_encoding_cache(photos_by_rfid, cached_index)
+print(f"💾 Reused {reused_photos} cached photo encodings")
+
+# Student registry as parallel arrays: student i is student_names[i] / student_ids[i], and its
+# reference encodings are the contiguous rows ref_matrix[enc_offsets[i]:enc_offsets[i + 1]]
+rfid_to_idx = {}
+student_names, student_ids = [], []
+ref_rows, offsets = [], [0]
+for rfid, (s, encs) in loaded_by_rfid.items():
+    rfid_to_idx[rfid] = len(student_names)
+    student_names.append(s["name"])
+    student_ids.append(s["id"])
+    ref_rows.extend(encs)
+    offsets.append(len(ref_rows))
+ref_matrix = quantize_encodings(np.asarray(ref_rows, dtype=np.float32).reshape(-1, 128))
+enc_offsets = np.asarray(offsets, dtype=np.int64)
+del loaded_by_rfid, ref_rows, offsets
+
+# Compile the quality kernel now rather than on the Tk thread at the first unknown face.
+# Crops are usually strided views of the frame, which Numba compiles separately from contiguous arrays.
+face_quality(np.zeros((60, 60, 3), dtype=np.uint8))
+face_quality(np.zeros((64, 64, 3), dtype=np.uint8)[2:62, 2:62])
+
+# ===== Unknown faces =====
+class UnknownFaceStore:
+    # Append-only store of unknown-face encodings: a FAISS flat L2 index when faiss is
+    # installed, otherwise a float32 buffer whose capacity doubles when full
+    def __init__(self, capacity=64):
+        self._index = faiss.IndexFlatL2(128) if faiss is not None else None
+        self._buf = np.empty((capacity if self._index is None else 0, 128), dtype=np.float32)
+        self._len = 0
+
+    def __len__(self):
+        return self._index.ntotal if self._index is not None else self._len
+
+    def add(self, enc):
+        if self._index is not None:
+            self._index.add(enc.astype(np.float32).reshape(1, 128))
+            return
+        if self._len == len(self._buf):
+            grown = np.empty((2 * len(self._buf), 128), dtype=np.float32)
+            grown[:self._len] = self._buf[:self._len]
+            self._buf = grown
+        self._buf[self._len] = enc
+        self._len += 1
+
+    def min_distance_sq(self, enc):
+        if self._index is not None:
+            d2, _ = self._index.search(enc.astype(np.float32).reshape(1, 128), 1)
+            return d2[0, 0]
+        diff = self._buf[:self._len] - enc.astype(np.float32)
+        return np.einsum("ij,ij->i", diff, diff).min()
+
 # ===== Tkinter App =====
 class RFIDFaceApp:
     def __init__(self, master):
@@ -100,6 +362,10 @@ class RFIDFaceApp:
         if not self.cap.isOpened():
             print("❌ Cannot open camera")
             raise SystemExit(1)
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, CAMERA_WIDTH)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, CAMERA_HEIGHT)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)   # always read the newest frame, not a stale queued one
 
         # UI
         self.video_label = tk.Label(self.master)
@@ -128,14 +394,28 @@ class RFIDFaceApp:
 
         # Session state
         self.pending_rfid = None
+        self.pending_idx = None      # registry index of the scanned student, if known
+        self.pending_refs = None     # that student's reference rows, widened to int32 once per scan
         self.session_start_ts = 0.0
         self.session_attendance_marked = False
         self.session_match_logged = False
         self.session_unknown_logged = False
         self.last_boxes_and_labels = []
+        self._frame_counter = 0
+
+        # Preview buffers, reused every frame (see render_frame)
+        self._rgb_buf = None
+        self._tk_img = None
 
         # Unknown dedupe
-        self.unknown_encodings = []
+        self.unknown_encodings = UnknownFaceStore()
+
+        # Network calls (Supabase storage/DB) run here so the frame loop never waits on I/O
+        self.io_pool = ThreadPoolExecutor(max_workers=4)
+
+        # (student_id, date) pairs known to have attendance, so repeat matches skip the Supabase check
+        self._marked_today = set()
+        self.io_pool.submit(self.load_marked_today)
 
         self.update_frame()
 
@@ -147,16 +427,26 @@ class RFIDFaceApp:
         self.log_area.config(state=tk.DISABLED)
         print(message)
 
+    # ---------- Background I/O ----------
+    def run_io(self, on_done, fn, *args):
+        # Run fn(*args) on the I/O pool and hand its result to on_done on the Tk thread
+        future = self.io_pool.submit(fn, *args)
+        future.add_done_callback(lambda f: self.master.after(0, on_done, f.result()))
+
     # ---------- RFID ----------
     def on_rfid_enter(self, event=None):
         code = self.rfid_input.get().strip()
         self.rfid_input.delete(0, tk.END)
         self.reset_session()
-        self.pending_rfid = code
+        self.pending_rfid = rfid_key(code)
         self.session_start_ts = time.time()
 
-        if code in student_by_rfid:
-            name = student_by_rfid[code]["name"]
+        idx = rfid_to_idx.get(self.pending_rfid)
+        if idx is not None:
+            self.pending_idx = idx
+            # int32, not int16: a squared int8 difference can reach 254 ** 2
+            self.pending_refs = ref_matrix[enc_offsets[idx]:enc_offsets[idx + 1]].astype(np.int32)
+            name = student_names[idx]
             self.rfid_status_var.set(f"✅ RFID scanned successfully: {name}")
             self.status_var.set("📷 Please look at the camera...")
             self.log(f"🔑 RFID scanned successfully: {code} → {name}")
@@ -167,11 +457,14 @@ class RFIDFaceApp:
 
     def reset_session(self):
         self.pending_rfid = None
+        self.pending_idx = None
+        self.pending_refs = None
         self.session_start_ts = 0.0
         self.session_attendance_marked = False
         self.session_match_logged = False
         self.session_unknown_logged = False
         self.last_boxes_and_labels = []
+        self._frame_counter = 0
 
         # Reset UI
         self.rfid_status_var.set("🔄 Waiting for RFID card...")
@@ -180,153 +473,194 @@ class RFIDFaceApp:
         self.rfid_input.focus_set()
 
     # ---------- Attendance ----------
+    def load_marked_today(self):
+        # Runs on the I/O pool: one query covers every student already marked today
+        day = today_str()
+        try:
+            rows = supabase.table("attendance").select("student_id").eq("date", day).execute().data or []
+            self._marked_today.update((r["student_id"], day) for r in rows)
+        except Exception as e:
+            self.master.after(0, self.log, f"⚠️ Could not preload today's attendance: {e}")
+
     def mark_attendance_once(self, rfid_code, snapshot_url=None):
-        if rfid_code not in student_by_rfid:
+        idx = rfid_to_idx.get(rfid_code)
+        if idx is None:
             return "error", "❌ No student found for this RFID."
-        student = student_by_rfid[rfid_code]
-        sid = student["id"]
+        sid, name = student_ids[idx], student_names[idx]
+        day = today_str()
+        if (sid, day) in self._marked_today:
+            return "already", f"ℹ️ Attendance already marked today for {name}."
         try:
             existing = supabase.table("attendance").select("id") \
-                .eq("student_id", sid).eq("date", today_str()).limit(1).execute()
+                .eq("student_id", sid).eq("date", day).limit(1).execute()
             if existing.data:
-                return "already", f"ℹ️ Attendance already marked today for {student['name']}."
+                self._marked_today.add((sid, day))
+                return "already", f"ℹ️ Attendance already marked today for {name}."
             supabase.table("attendance").insert({
                 "student_id": sid,
-                "date": today_str(),
+                "date": day,
                 "time": now_time_str(),
                 "snapshot_url": snapshot_url
             }).execute()
-            return "marked", f"✅ Attendance marked for {student['name']}."
+            self._marked_today.add((sid, day))
+            return "marked", f"✅ Attendance marked for {name}."
         except Exception as e:
             return "error", f"❌ Failed to mark attendance: {e}"
 
+    def upload_and_mark(self, jpeg, rfid_code):
+        # Runs on the I/O pool
+        snapshot_url = self.upload_snapshot(jpeg, prefix="attendance")
+        return self.mark_attendance_once(rfid_code, snapshot_url=snapshot_url)
+
+    def on_mark_done(self, session_ts, result):
+        status, msg = result
+        if session_ts == self.session_start_ts:
+            self.session_attendance_marked = (status in ["marked", "already"])
+        self.log(msg)
+
     # ---------- Storage ----------
-    def upload_snapshot(self, face_bgr, prefix="unknown"):
-        if face_bgr is None or face_bgr.size == 0:
+    def upload_snapshot(self, jpeg, prefix="unknown"):
+        # Runs on the I/O pool; jpeg comes from encode_snapshot on the Tk thread
+        if not jpeg:
             return None
         ts = datetime.now().strftime("%Y%m%d_%H%M%S")
         fname = f"{prefix}_{ts}.jpg"
         storage_path = f"{prefix}/{fname}"
-        tmp_path = os.path.join(tempfile.gettempdir(), fname)
-        cv2.imwrite(tmp_path, face_bgr)
         try:
-            with open(tmp_path, "rb") as fh:
-                supabase.storage.from_(SNAPSHOT_BUCKET).upload(
-                    storage_path, fh, {"content-type": "image/jpeg", "upsert": "true"}
-                )
+            supabase.storage.from_(SNAPSHOT_BUCKET).upload(
+                storage_path, jpeg, {"content-type": "image/jpeg", "upsert": "true"}
+            )
             return supabase.storage.from_(SNAPSHOT_BUCKET).get_public_url(storage_path)
         except Exception as e:
-            self.log(f"❌ Snapshot upload error: {e}")
+            self.master.after(0, self.log, f"❌ Snapshot upload error: {e}")
             return None
-        finally:
-            try:
-                os.remove(tmp_path)
-            except Exception:
-                pass
 
     def maybe_save_unknown_once(self, face_bgr, enc, rfid_code=None):
+        # Returns a message to log now; the upload result is logged by on_unknown_saved
         if self.session_unknown_logged:
-            return False, None, None
+            return None
         if not is_good_shot(face_bgr):
-            return False, "⚠️ Skipped bad quality face.", None
-        if self.unknown_encodings:
-            distances = face_recognition.face_distance(self.unknown_encodings, enc)
-            if len(distances) and float(np.min(distances)) < UNKNOWN_FACE_THRESHOLD:
+            return "⚠️ Skipped bad quality face."
+        if len(self.unknown_encodings):
+            if self.unknown_encodings.min_distance_sq(enc) < UNKNOWN_FACE_THRESHOLD_SQ:
                 self.session_unknown_logged = True
-                return True, "ℹ️ Similar unknown face already saved earlier.", None
-        prefix = "mismatch" if rfid_code in student_by_rfid else "unknown"
-        url = self.upload_snapshot(face_bgr, prefix=prefix)
-        if url:
-            self.unknown_encodings.append(enc)
-            self.session_unknown_logged = True
-            return True, f"📸 Unknown face saved: {url}", url
+                return "ℹ️ Similar unknown face already saved earlier."
+        prefix = "mismatch" if rfid_code in rfid_to_idx else "unknown"
         self.session_unknown_logged = True
-        return False, "❌ Failed to save unknown face.", None
+        # Encode now: the frame the crop views is drawn on before the upload runs
+        self.run_io(partial(self.on_unknown_saved, enc), self.upload_snapshot, encode_snapshot(face_bgr), prefix)
+        return None
+
+    def on_unknown_saved(self, enc, url):
+        if url:
+            self.unknown_encodings.add(enc)
+            self.log(f"📸 Unknown face saved: {url}")
+        else:
+            self.log("❌ Failed to save unknown face.")
 
     # ---------- Frame loop ----------
+    def schedule_next_frame(self):
+        delay = FRAME_INTERVAL_MS if self.session_start_ts > 0 else IDLE_FRAME_INTERVAL_MS
+        self.master.after(delay, self.update_frame)
+
     def update_frame(self):
         ok, frame = self.cap.read()
         if not ok:
-            self.master.after(30, self.update_frame)
+            self.schedule_next_frame()
             return
 
-        display = frame.copy()
         now_ts = time.time()
         active = (self.session_start_ts > 0)
-
+        # The first frame of a session is always a detection frame (reset_session zeroes the counter)
+        run_detection = active and self._frame_counter % DETECT_EVERY == 0
         if active:
+            self._frame_counter += 1
+
+        if run_detection:
             elapsed = now_ts - self.session_start_ts
             small = cv2.resize(frame, (0, 0), fx=0.25, fy=0.25)
             rgb_small = cv2.cvtColor(small, cv2.COLOR_BGR2RGB)
-            face_locations = face_recognition.face_locations(rgb_small)
+            face_locations = face_recognition.face_locations(rgb_small, model=FACE_DETECTION_MODEL)
             face_encodings = face_recognition.face_encodings(rgb_small, face_locations)
             new_boxes_and_labels = []
 
+            student_idx = self.pending_idx
+            ref_encs = self.pending_refs
+
             for (top, right, bottom, left), enc in zip(face_locations, face_encodings):
                 t, r, b, l = top * 4, right * 4, bottom * 4, left * 4
-                face_crop = frame[t:b, l:r]
+                face_crop = frame[t:b, l:r]   # view; JPEG-encoded before it leaves this tick
 
                 match = False
-                if self.pending_rfid in encodings_by_rfid:
-                    ref_encs = encodings_by_rfid[self.pending_rfid]
-                    distances = face_recognition.face_distance(ref_encs, enc)
-                    if len(distances) and float(np.min(distances)) <= MATCH_THRESHOLD:
-                        match = True
+                if ref_encs is not None:
+                    diff = ref_encs - quantize_encodings(enc)
+                    d2 = np.einsum("ij,ij->i", diff, diff)
+                    match = d2.min() <= MATCH_THRESHOLD_Q_SQ
 
                 # ----- Timing / UI logic -----
                 if elapsed <= SCAN_PHASE:
                     color = (255, 0, 0); label_text = "SCANNING..."
                     self.status_var.set("Scanning… Please hold still.")
                 elif elapsed <= DECISION_PHASE:
-                    if self.pending_rfid in student_by_rfid:
+                    if student_idx is not None:
                         if match:
                             color = (0, 255, 0)
-                            label_text = f"VERIFIED: {student_by_rfid[self.pending_rfid]['name']}"
+                            label_text = f"VERIFIED: {student_names[student_idx]}"
                             self.status_var.set("Verified ✅")
                             if not self.session_attendance_marked and not self.session_match_logged:
-                                snapshot_url = self.upload_snapshot(face_crop, prefix="attendance")
-                                status, msg = self.mark_attendance_once(self.pending_rfid, snapshot_url=snapshot_url)
-                                self.session_attendance_marked = (status in ["marked", "already"])
-                                self.log(msg)
                                 self.session_match_logged = True
+                                if (student_ids[student_idx], today_str()) in self._marked_today:
+                                    # Already marked: skip the snapshot upload and the DB round trip
+                                    self.session_attendance_marked = True
+                                    self.log(f"ℹ️ Attendance already marked today for {student_names[student_idx]}.")
+                                else:
+                                    self.run_io(partial(self.on_mark_done, self.session_start_ts),
+                                                self.upload_and_mark, encode_snapshot(face_crop), self.pending_rfid)
 
                         else:
                             color = (0, 0, 255); label_text = "MISMATCH"
                             self.status_var.set("Mismatch ❌")
                             if not self.session_unknown_logged:
-                                saved, umsg, url = self.maybe_save_unknown_once(face_crop, enc, rfid_code=self.pending_rfid)
+                                umsg = self.maybe_save_unknown_once(face_crop, enc, rfid_code=self.pending_rfid)
                                 if umsg: self.log(umsg)
                     else:
                         color = (0, 0, 255); label_text = "UNKNOWN RFID"
                         self.status_var.set("Unknown RFID ❌")
                         if not self.session_unknown_logged:
-                            saved, umsg, _ = self.maybe_save_unknown_once(face_crop, enc)
+                            umsg = self.maybe_save_unknown_once(face_crop, enc)
                             if umsg: self.log(umsg)
                 else:
                     self.log("⏱ Session timeout → resetting.")
                     self.reset_session()
                     self.last_boxes_and_labels = []
-                    self.render_frame(display)
-                    self.master.after(30, self.update_frame)
+                    self.render_frame(frame)
+                    self.schedule_next_frame()
                     return
 
                 new_boxes_and_labels.append((l, t, r, b, color, label_text))
 
             self.last_boxes_and_labels = new_boxes_and_labels
 
-        # Draw rectangles/labels
+        # Draw rectangles/labels straight onto the captured frame
         for (l, t, r, b, color, text) in self.last_boxes_and_labels:
-            cv2.rectangle(display, (l, t), (r, b), color, 2)
-            cv2.putText(display, text, (l, t - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
+            cv2.rectangle(frame, (l, t), (r, b), color, 2)
+            cv2.putText(frame, text, (l, t - 10), cv2.FONT_HERSHEY_SIMPLEX, 0.8, color, 2)
 
-        self.render_frame(display)
-        self.master.after(30, self.update_frame)
+        self.render_frame(frame)
+        self.schedule_next_frame()
 
     def render_frame(self, bgr):
-        img = Image.fromarray(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
-        imgtk = ImageTk.PhotoImage(image=img)
-        self.video_label.imgtk = imgtk
-        self.video_label.configure(image=imgtk)
+        h, w = bgr.shape[:2]
+        if self._rgb_buf is None or self._rgb_buf.shape[:2] != (h, w):
+            # (Re)allocate only when the camera frame size changes
+            self._rgb_buf = np.empty((h, w, 3), dtype=np.uint8)
+            self._tk_img = ImageTk.PhotoImage(image=Image.new("RGB", (w, h)))
+            self.video_label.configure(image=self._tk_img)
+        # The Tk image and scratch buffer are reused, but Pillow still copies per frame:
+        # frombuffer("RGB") copies via frombytes, and paste() converts into a fresh block
+        # before Tk copies it into the photo
+        cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB, dst=self._rgb_buf)
+        self._tk_img.paste(Image.frombuffer("RGB", (w, h), self._rgb_buf, "raw", "RGB", 0, 1))
 
 # ===== Run App =====
 if __name__ == "__main__":